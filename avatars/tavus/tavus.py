@@ -1,20 +1,24 @@
+import functools
 import logging
-import json
-import uuid
+import orjson
+import secrets
 from dotenv import load_dotenv
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing_extensions import TypedDict, List, Optional
+from typing_extensions import AsyncIterator, TypedDict, Dict, List, Optional
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 from livekit.agents.llm import function_tool
 from livekit.agents.voice import Agent, AgentSession, RunContext
 from livekit.agents import (
     JobContext,
+    JobProcess,
     WorkerOptions,
     cli,
     RoomOutputOptions,
     RoomInputOptions,
+    tts,
 )
+from livekit import rtc
 from livekit.plugins import (
     noise_cancellation,
     deepgram,
@@ -27,11 +31,41 @@ from livekit.plugins import (
 import asyncio
 
 
-env_path = Path(__file__).parent.parent / ".env"
-load_dotenv(dotenv_path=Path(__file__).parent.parent / ".env")
+ENV_PATH = Path(__file__).parent.parent / ".env"
+load_dotenv(dotenv_path=ENV_PATH)
 logger = logging.getLogger("avatar")
 logger.setLevel(logging.INFO)
 
+# Participant kinds treated as the client, matching ctx.wait_for_participant()
+_CLIENT_PARTICIPANT_KINDS = (
+    rtc.ParticipantKind.PARTICIPANT_KIND_STANDARD,
+    rtc.ParticipantKind.PARTICIPANT_KIND_SIP,
+)
+
+# Per-question feedback read back to the student after a quiz submission
+_CORRECT_FMT = "Question: {qt}\nYour answer: {sa} ✓ Correct!"
+_INCORRECT_FMT = (
+    "Question: {qt}\nYour answer: {sa} ✗ Incorrect. The correct answer is: {ca}"
+)
+# Synthesized quiz responses kept per session for retries (each is ~1-2 MB of PCM)
+_TTS_CACHE_SIZE = 2
+
+
+@functools.lru_cache(maxsize=2048)
+def _format_feedback(
+    question_text: str, selected_text: str, correct_text: str, is_correct: bool
+) -> str:
+    """Format the feedback line for a single quiz question."""
+    if is_correct:
+        return _CORRECT_FMT.format(qt=question_text, sa=selected_text)
+    return _INCORRECT_FMT.format(qt=question_text, sa=selected_text, ca=correct_text)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_flip(payload_str: str) -> Dict:
+    """Parse a flash card flip payload. The cached result must not be mutated."""
+    return orjson.loads(payload_str)
+
 
 class QuizAnswerDict(TypedDict):
     text: str
@@ -43,7 +77,7 @@ class QuizQuestionDict(TypedDict):
     answers: List[QuizAnswerDict]
 
 
-@dataclass
+@dataclass(slots=True)
 class FlashCard:
     """Class to represent a flash card."""
 
@@ -51,9 +85,12 @@ class FlashCard:
     question: str
     answer: str
     is_flipped: bool = False
+    # Serialized RPC payloads, built once when the card is added
+    show_payload: str = field(default="", init=False, repr=False, compare=False)
+    flip_payload: str = field(default="", init=False, repr=False, compare=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class QuizAnswer:
     """Class to represent a quiz answer option."""
 
@@ -62,21 +99,24 @@ class QuizAnswer:
     is_correct: bool
 
 
-@dataclass
+@dataclass(slots=True)
 class QuizQuestion:
     """Class to represent a quiz question."""
 
     id: str
     text: str
     answers: List[QuizAnswer]
+    answers_by_id: Dict[str, QuizAnswer] = field(default_factory=dict)
+    correct_answer: Optional[QuizAnswer] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Quiz:
     """Class to represent a quiz."""
 
     id: str
     questions: List[QuizQuestion]
+    client_payload: Dict = field(default_factory=dict)
 
 
 @dataclass
@@ -84,25 +124,69 @@ class UserData:
     """Class to store user data during a session."""
 
     ctx: Optional[JobContext] = None
+    client_identity: Optional[str] = None
     flash_cards: List[FlashCard] = field(default_factory=list)
     quizzes: List[Quiz] = field(default_factory=list)
+    tts_cache: Dict[str, List[rtc.AudioFrame]] = field(default_factory=dict)
 
-    def reset(self) -> None:
-        """Reset session data."""
-        # Keep flash cards and quizzes intact
+    def __post_init__(self) -> None:
+        # Index cards and quizzes by ID so RPC lookups don't scan the lists
+        self._card_by_id: Dict[str, FlashCard] = {
+            card.id: card for card in self.flash_cards
+        }
+        self._quiz_by_id: Dict[str, Quiz] = {quiz.id: quiz for quiz in self.quizzes}
+        # The random prefix keeps IDs from colliding with cards a client still
+        # holds from an earlier session in the same room
+        self._id_prefix = secrets.token_hex(4)
+        self._id_counter = 0
+
+    def _next_id(self) -> str:
+        """Generate an ID that is unique across sessions."""
+        self._id_counter += 1
+        return f"{self._id_prefix}-{self._id_counter}"
+
+    async def synthesize_cached(
+        self, text: str, tts_engine: tts.TTS
+    ) -> AsyncIterator[rtc.AudioFrame]:
+        """Stream TTS audio for text, replaying frames cached for identical text."""
+        frames = self.tts_cache.pop(text, None)
+        if frames is not None:
+            # Re-insert so the most recently used response is evicted last
+            self.tts_cache[text] = frames
+            for frame in frames:
+                yield frame
+            return
+
+        frames = []
+        async with tts_engine.synthesize(text) as stream:
+            async for audio in stream:
+                frames.append(audio.frame)
+                yield audio.frame
+
+        if len(self.tts_cache) >= _TTS_CACHE_SIZE:
+            self.tts_cache.pop(next(iter(self.tts_cache)))
+        self.tts_cache[text] = frames
 
     def add_flash_card(self, question: str, answer: str) -> FlashCard:
         """Add a new flash card to the collection."""
-        card = FlashCard(id=str(uuid.uuid4()), question=question, answer=answer)
+        card = FlashCard(id=self._next_id(), question=question, answer=answer)
+        card.show_payload = orjson.dumps(
+            {
+                "action": "show",
+                "id": card.id,
+                "question": card.question,
+                "answer": card.answer,
+                "index": len(self.flash_cards),
+            }
+        ).decode()
+        card.flip_payload = orjson.dumps({"action": "flip", "id": card.id}).decode()
         self.flash_cards.append(card)
+        self._card_by_id[card.id] = card
         return card
 
     def get_flash_card(self, card_id: str) -> Optional[FlashCard]:
         """Get a flash card by ID."""
-        for card in self.flash_cards:
-            if card.id == card_id:
-                return card
-        return None
+        return self._card_by_id.get(card_id)
 
     def flip_flash_card(self, card_id: str) -> Optional[FlashCard]:
         """Flip a flash card by ID."""
@@ -114,29 +198,49 @@ class UserData:
 
     def add_quiz(self, questions: List[QuizQuestionDict]) -> Quiz:
         """Add a new quiz to the collection."""
-        quiz_questions = []
+        # Build the client-facing questions in the same pass
+        quiz_questions: List[QuizQuestion] = []
+        client_questions: List[Dict] = []
         for q in questions:
             answers = []
+            answers_by_id = {}
+            correct_answer = None
+            # Client-facing answers leave out which one is correct
+            client_answers = []
             for a in q["answers"]:
-                answers.append(
-                    QuizAnswer(
-                        id=str(uuid.uuid4()), text=a["text"], is_correct=a["is_correct"]
-                    )
+                answer = QuizAnswer(
+                    id=self._next_id(), text=a["text"], is_correct=a["is_correct"]
                 )
-            quiz_questions.append(
-                QuizQuestion(id=str(uuid.uuid4()), text=q["text"], answers=answers)
+                answers.append(answer)
+                answers_by_id[answer.id] = answer
+                if answer.is_correct:
+                    correct_answer = answer
+                client_answers.append({"id": answer.id, "text": answer.text})
+            question = QuizQuestion(
+                id=self._next_id(),
+                text=q["text"],
+                answers=answers,
+                answers_by_id=answers_by_id,
+                correct_answer=correct_answer,
+            )
+            quiz_questions.append(question)
+            client_questions.append(
+                {"id": question.id, "text": question.text, "answers": client_answers}
             )
 
-        quiz = Quiz(id=str(uuid.uuid4()), questions=quiz_questions)
+        quiz = Quiz(id=self._next_id(), questions=quiz_questions)
+        quiz.client_payload = {
+            "action": "show",
+            "id": quiz.id,
+            "questions": client_questions,
+        }
         self.quizzes.append(quiz)
+        self._quiz_by_id[quiz.id] = quiz
         return quiz
 
     def get_quiz(self, quiz_id: str) -> Optional[Quiz]:
         """Get a quiz by ID."""
-        for quiz in self.quizzes:
-            if quiz.id == quiz_id:
-                return quiz
-        return None
+        return self._quiz_by_id.get(quiz_id)
 
     def check_quiz_answers(self, quiz_id: str, user_answers: dict) -> List[tuple]:
         """Check user's quiz answers and return results."""
@@ -146,28 +250,22 @@ class UserData:
 
         results = []
         for question in quiz.questions:
-            user_answer_id = user_answers.get(question.id)
-
-            # Find the selected answer and the correct answer
-            selected_answer = None
-            correct_answer = None
-
-            for answer in question.answers:
-                if answer.id == user_answer_id:
-                    selected_answer = answer
-                if answer.is_correct:
-                    correct_answer = answer
-
-            is_correct = selected_answer and selected_answer.is_correct
-            results.append((question, selected_answer, correct_answer, is_correct))
+            answer_id = user_answers.get(question.id)
+            # Malformed (non-string) answer values count as unanswered
+            selected_answer = (
+                question.answers_by_id.get(answer_id)
+                if isinstance(answer_id, str)
+                else None
+            )
+            is_correct = bool(selected_answer and selected_answer.is_correct)
+            results.append(
+                (question, selected_answer, question.correct_answer, is_correct)
+            )
 
         return results
 
 
-class AvatarAgent(Agent):
-    def __init__(self) -> None:
-        super().__init__(
-            instructions="""
+TUTOR_INSTRUCTIONS = """
                 You are a friendly English tutor who will first greet and ask for the student's name, then greet them again using their name. After that, you will teach English based on topics chosen by the student.
 
                 Initial greeting sequence:
@@ -241,11 +339,17 @@ class AvatarAgent(Agent):
                    - Create appropriate flashcards or quizzes
                    - Explain why you're providing additional materials
                    - Keep the conversation flowing naturally
-            """,
+            """
+
+
+class AvatarAgent(Agent):
+    def __init__(self, vad: silero.VAD) -> None:
+        super().__init__(
+            instructions=TUTOR_INSTRUCTIONS,
             stt=deepgram.STT(),
             llm=openai.LLM(model="gpt-4.1-nano"),
             tts=elevenlabs.TTS(voice_id="21m00Tcm4TlvDq8ikWAM"),
-            vad=silero.VAD.load(),
+            vad=vad,
         )
 
     @function_tool
@@ -267,30 +371,16 @@ class AvatarAgent(Agent):
 
         room = userdata.ctx.room
 
-        # Get the first participant in the room (should be the client)
-        participants = room.remote_participants
-        if not participants:
+        # The client identity is tracked from room participant events
+        identity = userdata.client_identity
+        if not identity:
             return f"Created a flash card, but no participants found to send it to."
 
-        # Get the first participant from the dictionary of remote participants
-        participant = next(iter(participants.values()), None)
-        if not participant:
-            return f"Created a flash card, but couldn't get the first participant."
-        payload = {
-            "action": "show",
-            "id": card.id,
-            "question": card.question,
-            "answer": card.answer,
-            "index": len(userdata.flash_cards) - 1,
-        }
-
-        # Make sure payload is properly serialized
-        json_payload = json.dumps(payload)
-        logger.info(f"Sending flash card payload: {json_payload}")
+        logger.info("Sending flash card payload: %s", card.show_payload)
         await room.local_participant.perform_rpc(
-            destination_identity=participant.identity,
+            destination_identity=identity,
             method="client.flashcard",
-            payload=json_payload,
+            payload=card.show_payload,
         )
 
         return f"I've created a flash card with the question: '{question}'"
@@ -314,24 +404,16 @@ class AvatarAgent(Agent):
 
         room = userdata.ctx.room
 
-        # Get the first participant in the room (should be the client)
-        participants = room.remote_participants
-        if not participants:
+        # The client identity is tracked from room participant events
+        identity = userdata.client_identity
+        if not identity:
             return f"Flipped the flash card, but no participants found to send it to."
 
-        # Get the first participant from the dictionary of remote participants
-        participant = next(iter(participants.values()), None)
-        if not participant:
-            return f"Flipped the flash card, but couldn't get the first participant."
-        payload = {"action": "flip", "id": card.id}
-
-        # Make sure payload is properly serialized
-        json_payload = json.dumps(payload)
-        logger.info(f"Sending flip card payload: {json_payload}")
+        logger.info("Sending flip card payload: %s", card.flip_payload)
         await room.local_participant.perform_rpc(
-            destination_identity=participant.identity,
+            destination_identity=identity,
             method="client.flashcard",
-            payload=json_payload,
+            payload=card.flip_payload,
         )
 
         return f"I've flipped the flash card to show the {'answer' if card.is_flipped else 'question'}"
@@ -358,33 +440,16 @@ class AvatarAgent(Agent):
 
         room = userdata.ctx.room
 
-        # Get the first participant in the room (should be the client)
-        participants = room.remote_participants
-        if not participants:
+        # The client identity is tracked from room participant events
+        identity = userdata.client_identity
+        if not identity:
             return f"Created a quiz, but no participants found to send it to."
 
-        # Get the first participant from the dictionary of remote participants
-        participant = next(iter(participants.values()), None)
-        if not participant:
-            return f"Created a quiz, but couldn't get the first participant."
-
-        # Format questions for client
-        client_questions = []
-        for q in quiz.questions:
-            client_answers = []
-            for a in q.answers:
-                client_answers.append({"id": a.id, "text": a.text})
-            client_questions.append(
-                {"id": q.id, "text": q.text, "answers": client_answers}
-            )
-
-        payload = {"action": "show", "id": quiz.id, "questions": client_questions}
-
         # Make sure payload is properly serialized
-        json_payload = json.dumps(payload)
-        logger.info(f"Sending quiz payload: {json_payload}")
+        json_payload = orjson.dumps(quiz.client_payload).decode()
+        logger.info("Sending quiz payload: %s", json_payload)
         await room.local_participant.perform_rpc(
-            destination_identity=participant.identity,
+            destination_identity=identity,
             method="client.quiz",
             payload=json_payload,
         )
@@ -396,6 +461,11 @@ class AvatarAgent(Agent):
         self.session.generate_reply()
 
 
+def prewarm(proc: JobProcess):
+    # Load the VAD once per worker process, before any job is assigned to it
+    proc.userdata["vad"] = silero.VAD.load()
+
+
 async def entrypoint(ctx: JobContext):
     await ctx.connect()
     # Get metadat from participants
@@ -408,14 +478,31 @@ async def entrypoint(ctx: JobContext):
     # logger.info(f"Participant disconnect reason: {participant.disconnect_reason}")
     # logger.info(f"Participant track_publications: {participant.track_publications}")
 
-    agent = AvatarAgent()
+    agent = AvatarAgent(vad=ctx.proc.userdata["vad"])
 
     # Create a single AgentSession with userdata
-    userdata = UserData(ctx=ctx)
+    userdata = UserData(ctx=ctx, client_identity=participant.identity)
     session = AgentSession[UserData](
         userdata=userdata, turn_detection=MultilingualModel()
     )
 
+    # Keep track of the client participant so RPCs don't have to look it up. Only
+    # standard/SIP participants count, so the avatar's own participant is ignored.
+    def on_participant_connected(remote_participant: rtc.RemoteParticipant):
+        if (
+            userdata.client_identity is None
+            and remote_participant.kind in _CLIENT_PARTICIPANT_KINDS
+        ):
+            userdata.client_identity = remote_participant.identity
+
+    def on_participant_disconnected(remote_participant: rtc.RemoteParticipant):
+        # Clear it so the client is picked up again when it reconnects
+        if userdata.client_identity == remote_participant.identity:
+            userdata.client_identity = None
+
+    ctx.room.on("participant_connected", on_participant_connected)
+    ctx.room.on("participant_disconnected", on_participant_disconnected)
+
     # Create the avatar session
     avatar = tavus.AvatarSession(
         replica_id="ra54d1d861",
@@ -426,15 +513,15 @@ async def entrypoint(ctx: JobContext):
     # Register RPC method for flipping flash cards from client
     async def handle_flip_flash_card(rpc_data):
         try:
-            logger.info(f"Received flash card flip payload: {rpc_data}")
+            logger.info("Received flash card flip payload: %s", rpc_data)
 
             # Extract the payload from the RpcInvocationData object
             payload_str = rpc_data.payload
-            logger.info(f"Extracted payload string: {payload_str}")
+            logger.info("Extracted payload string: %s", payload_str)
 
-            # Parse the JSON payload
-            payload_data = json.loads(payload_str)
-            logger.info(f"Parsed payload data: {payload_data}")
+            # Parse the JSON payload, reusing the result for repeated flips
+            payload_data = _parse_flip(payload_str)
+            logger.info("Parsed payload data: %s", payload_data)
 
             card_id = payload_data.get("id")
 
@@ -442,35 +529,37 @@ async def entrypoint(ctx: JobContext):
                 card = userdata.flip_flash_card(card_id)
                 if card:
                     logger.info(
-                        f"Flipped flash card {card_id}, is_flipped: {card.is_flipped}"
+                        "Flipped flash card %s, is_flipped: %s",
+                        card_id,
+                        card.is_flipped,
                     )
                     # Send a message to the user via the agent, we're disabling this for now.
                     # session.generate_reply(user_input=(f"Please describe the {'answer' if card.is_flipped else 'question'}"))
                 else:
-                    logger.error(f"Card with ID {card_id} not found")
+                    logger.error("Card with ID %s not found", card_id)
             else:
                 logger.error("No card ID found in payload")
 
             return None
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parsing error for payload '{rpc_data.payload}': {e}")
+        except orjson.JSONDecodeError as e:
+            logger.error("JSON parsing error for payload '%s': %s", rpc_data.payload, e)
             return f"error: {str(e)}"
         except Exception as e:
-            logger.error(f"Error handling flip flash card: {e}")
+            logger.error("Error handling flip flash card: %s", e)
             return f"error: {str(e)}"
 
     # Register RPC method for handling quiz submissions
     async def handle_submit_quiz(rpc_data):
         try:
-            logger.info(f"Received quiz submission payload: {rpc_data}")
+            logger.info("Received quiz submission payload: %s", rpc_data)
 
             # Extract the payload from the RpcInvocationData object
             payload_str = rpc_data.payload
-            logger.info(f"Extracted quiz submission string: {payload_str}")
+            logger.info("Extracted quiz submission string: %s", payload_str)
 
             # Parse the JSON payload
-            payload_data = json.loads(payload_str)
-            logger.info(f"Parsed quiz submission data: {payload_data}")
+            payload_data = orjson.loads(payload_str)
+            logger.info("Parsed quiz submission data: %s", payload_data)
 
             quiz_id = payload_data.get("id")
             user_answers = payload_data.get("answers", {})
@@ -482,11 +571,11 @@ async def entrypoint(ctx: JobContext):
             # Check the quiz answers
             quiz_results = userdata.check_quiz_answers(quiz_id, user_answers)
             if not quiz_results:
-                logger.error(f"Quiz with ID {quiz_id} not found")
+                logger.error("Quiz with ID %s not found", quiz_id)
                 return "error: Quiz not found"
 
             # Count correct answers
-            correct_count = sum(1 for _, _, _, is_correct in quiz_results if is_correct)
+            correct_count = sum(is_correct for _, _, _, is_correct in quiz_results)
             total_count = len(quiz_results)
 
             # Create a verbal response for the agent to say
@@ -495,49 +584,62 @@ async def entrypoint(ctx: JobContext):
             )
 
             # Generate feedback for each question
+            identity = userdata.client_identity
             feedback_details = []
+            flash_tasks = []
             for question, selected_answer, correct_answer, is_correct in quiz_results:
-                if is_correct:
-                    feedback = f"Question: {question.text}\nYour answer: {selected_answer.text} ✓ Correct!"
-                else:
-                    feedback = f"Question: {question.text}\nYour answer: {selected_answer.text if selected_answer else 'None'} ✗ Incorrect. The correct answer is: {correct_answer.text}"
+                feedback_details.append(
+                    _format_feedback(
+                        question.text,
+                        selected_answer.text if selected_answer else "None",
+                        correct_answer.text if correct_answer else "None",
+                        is_correct,
+                    )
+                )
 
-                    # Create a flash card for incorrectly answered questions
+                # Create a flash card for incorrectly answered questions, unless the
+                # quiz never marked a correct answer to put on it
+                if not is_correct and correct_answer:
                     card = userdata.add_flash_card(question.text, correct_answer.text)
-                    participant = next(
-                        iter(ctx.room.remote_participants.values()), None
-                    )
-                    if participant:
-                        flash_payload = {
-                            "action": "show",
-                            "id": card.id,
-                            "question": card.question,
-                            "answer": card.answer,
-                            "index": len(userdata.flash_cards) - 1,
-                        }
-                        json_flash_payload = json.dumps(flash_payload)
-                        await ctx.room.local_participant.perform_rpc(
-                            destination_identity=participant.identity,
-                            method="client.flashcard",
-                            payload=json_flash_payload,
+                    if identity:
+                        # Start the send right away so it isn't lost if a later
+                        # question fails
+                        flash_tasks.append(
+                            asyncio.create_task(
+                                ctx.room.local_participant.perform_rpc(
+                                    destination_identity=identity,
+                                    method="client.flashcard",
+                                    payload=card.show_payload,
+                                )
+                            )
                         )
 
-                feedback_details.append(feedback)
+            # Send the flash cards concurrently rather than one round trip at a time,
+            # and keep going so a failed send doesn't swallow the quiz results
+            flash_results = await asyncio.gather(*flash_tasks, return_exceptions=True)
+            for result in flash_results:
+                if isinstance(result, Exception):
+                    logger.error("Error sending flash card: %s", result)
 
             detailed_feedback = "\n\n".join(feedback_details)
             full_response = f"{result_summary}\n\n{detailed_feedback}"
 
-            # Have the agent say the results
-            session.say(full_response)
+            # Have the agent say the results, reusing audio from an identical retry
+            session.say(
+                full_response,
+                audio=userdata.synthesize_cached(full_response, agent.tts),
+            )
 
             return "success"
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(
-                f"JSON parsing error for quiz submission payload '{rpc_data.payload}': {e}"
+                "JSON parsing error for quiz submission payload '%s': %s",
+                rpc_data.payload,
+                e,
             )
             return f"error: {str(e)}"
         except Exception as e:
-            logger.error(f"Error handling quiz submission: {e}")
+            logger.error("Error handling quiz submission: %s", e)
             return f"error: {str(e)}"
 
     # Register RPC methods - The method names need to match exactly what the client is calling
@@ -568,4 +670,4 @@ async def entrypoint(ctx: JobContext):
 
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))